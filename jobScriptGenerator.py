@@ -3,72 +3,106 @@
 import os
 import argparse
 
-def generate_local_merge_script(storage_path, scriptForMerge, mergeFilePattern):
+# Write buffer used when streaming generated scripts to disk: 1 MiB.
+WRITE_BUFFER_SIZE = 1 << 20
+
+def _list_subdirs(path):
+    """
+    List the names of the subdirectories of path with a single os.scandir pass
+    (entry.is_dir() uses the d_type from the directory listing, no extra stat).
+    """
+    with os.scandir(path) as it:
+        return [entry.name for entry in it if entry.is_dir(follow_symlinks=False)]
+
+def _write_lines(path, lines):
+    """
+    Stream the given lines to path through a large write buffer, one line at a time,
+    so the full script is never materialized as a single string.
+    """
+    with open(path, "w", buffering=WRITE_BUFFER_SIZE) as f:
+        for line in lines:
+            f.write(line)
+            f.write("\n")
+
+def _yield_local_script_lines(storage_path, subdirs_file, mergeFilePattern):
+    """
+    Yield the lines of the local run shell script for the subdirectories listed in subdirs_file.
     """
-    Generate a local run shell script that will run the merge script for every subdirectory under storage_path.
+    yield "#!/bin/bash"
+    yield f'export MERGE_DIR="{storage_path}"'
+    yield 'echo -e "  -- merger script -- > Set ntuple path [ ${MERGE_DIR} ]"'
+    yield ""
+    yield "if ! command -v parallel > /dev/null 2>&1; then"
+    yield '    echo "GNU parallel is required but was not found in PATH." >&2'
+    yield "    exit 1"
+    yield "fi"
+    yield ""
+    # Here, each job calls mergeOutput.py with:
+    # --dir pointing to the subdirectory,
+    # --pat using the mergeFilePattern,
+    # --out naming the merged file as <subdir>.root within the storage path.
+    # GNU parallel shell-quotes {} itself, so it is kept outside the double quotes.
+    # --line-buffer prints each job's log lines as they come (tagged with the subdirectory)
+    # instead of only once the job has finished; the subdirectories are read from subdirs_file.
+    yield (f'parallel -j "$(nproc)" --tag --line-buffer \'echo "Processing directory: "{{}}; '
+           f'python3 -u mergeOutput.py --dir "${{MERGE_DIR}}"/{{}} --pat "{mergeFilePattern}" --out "${{MERGE_DIR}}"/{{}}.root\' '
+           f':::: "{subdirs_file}"')
+    # parallel exits with the number of failed jobs (capped at 101 by GNU parallel).
+    yield "status=$?"
+    yield ""
+    yield 'if [ "${status}" -ne 0 ]; then'
+    yield '    echo "${status} merge job(s) failed." >&2'
+    yield '    exit "${status}"'
+    yield "fi"
+    yield 'echo "All merge jobs completed."'
+
+def generate_local_merge_script(storage_path, subdirs, scriptForMerge, mergeFilePattern):
+    """
+    Generate a local run shell script that will run the merge script for every subdirectory (subdirs) under storage_path.
     Each job will merge the files within one subdirectory using the given output file pattern.
+    The per-subdirectory jobs are run concurrently with GNU parallel (one job per core).
+    The subdirectory names are written to subdirs.txt next to the script, which GNU parallel reads.
     """
-    # List all subdirectories within storage_path.
-    subdirs = [d for d in os.listdir(storage_path) if os.path.isdir(os.path.join(storage_path, d))]
-    
-    lines = [
-        "#!/bin/bash",
-        f'MERGE_DIR="{storage_path}"',
-        'echo -e "  -- merger script -- > Set ntuple path [ ${MERGE_DIR} ]"',
-        ""
-    ]
-    
-    # Loop over each subdirectory found.
-    for subdir in subdirs:
-        lines.append(f'echo "Processing directory: {subdir}"')
-        # Here, the command calls mergeOutput.py with:
-        # --dir pointing to the subdirectory,
-        # --pat using the mergeFilePattern,
-        # --out naming the merged file as <subdir>.root within the storage path.
-        lines.append(f'python3 -u mergeOutput.py --dir "${{MERGE_DIR}}/{subdir}" --pat {mergeFilePattern} --out "${{MERGE_DIR}}/{subdir}.root"')
-        lines.append("")
-    
-    lines.append('echo "All merge jobs completed."')
-    
-    with open(scriptForMerge, "w") as f:
-        f.write("\n".join(lines))
+    subdirs_file = os.path.join(os.path.dirname(os.path.abspath(scriptForMerge)), "subdirs.txt")
+    _write_lines(subdirs_file, subdirs)
+    _write_lines(scriptForMerge, _yield_local_script_lines(storage_path, subdirs_file, mergeFilePattern))
     os.chmod(scriptForMerge, 0o755)
-    print(f"Local run script generated: {scriptForMerge}")
+    print(f"Local run script generated: {scriptForMerge} (subdirectory list: {subdirs_file})")
 
-def generate_condorMerge_submission_file(storage_path, scriptForMerge, mergeFilePattern):
+def generate_condorMerge_submission_file(storage_path, subdirs, scriptForMerge, mergeFilePattern):
     """
-    Generate a Condor job submission file. Each subdirectory under storage_path will be
+    Generate a Condor job submission file. Each subdirectory (subdirs) under storage_path will be
     treated as an individual job that merges all files within that subdirectory.
+    The subdirectory names are written to a separate list file read by "queue subdir from",
+    so the submission file has a constant size regardless of the number of subdirectories.
     """
  
+    # Create a directory for Condor logs if it doesn't exist
+    merge_condor_logs_dir = "merge_condor_logs"
+    os.makedirs(merge_condor_logs_dir, exist_ok=True)
+
+    # Write the subdirectories, one per line, next to the submission file.
+    subdirs_file = os.path.join(os.path.dirname(scriptForMerge), "subdirs.txt")
+    _write_lines(subdirs_file, subdirs)
+
     lines = [
         "Executable      = mergeOutput.py",
         "getenv          = True",
         "should_transfer_files = No",
         '+JobFlavour      = "tomorrow"',
-        ""
-    ]
-    
-    # List all subdirectories within storage_path.
-    subdirs = [d for d in os.listdir(storage_path) if os.path.isdir(os.path.join(storage_path, d))]
- 
-    # Create a directory for Condor logs if it doesn't exist
-    merge_condor_logs_dir = "merge_condor_logs"
-    os.makedirs(merge_condor_logs_dir, exist_ok=True)
-
-    for subdir in subdirs:
-        full_dir = os.path.join(storage_path, subdir)
+        f"MERGE_DIR       = {storage_path.rstrip('/')}",
+        "",
         # Each job uses the full directory as parameter and names the merged file as <subdir>.root.
-        lines.append(f'arguments = --dir {full_dir} --pat {mergeFilePattern} --out {full_dir}.root')
-        lines.append(f"Output          = merge_condor_logs/{subdir}_$(Cluster)_$(Process).out")
-        lines.append(f"Error           = merge_condor_logs/{subdir}_$(Cluster)_$(Process).err")
-        lines.append(f"Log             = merge_condor_logs/{subdir}_$(Cluster).log")
-        lines.append("queue")
-        lines.append("")
+        # The input size estimate is only informative, so batch jobs skip it.
+        f"arguments = --dir $(MERGE_DIR)/$(subdir) --pat {mergeFilePattern} --out $(MERGE_DIR)/$(subdir).root --skip-estimate",
+        f"Output          = {merge_condor_logs_dir}/$(subdir)_$(Cluster)_$(Process).out",
+        f"Error           = {merge_condor_logs_dir}/$(subdir)_$(Cluster)_$(Process).err",
+        f"Log             = {merge_condor_logs_dir}/$(subdir)_$(Cluster).log",
+        f"queue subdir from {subdirs_file}",
+    ]
     
-    with open(scriptForMerge, "w") as f:
-        f.write("\n".join(lines))
-    print(f"Condor submission file generated: {scriptForMerge}")
+    _write_lines(scriptForMerge, lines)
+    print(f"Condor submission file generated: {scriptForMerge} (subdirectory list: {subdirs_file})")
 
 def main():
     parser = argparse.ArgumentParser(
@@ -82,13 +116,16 @@ def main():
     username = os.getenv("USER")
     storage_path = f"/eos/cms/store/group/phys_jetmet/{username}/JMETriggerAnalysis/JESC/JESC_ntuple/250407_winter25v9/"
     mergeFilePattern = "out_*.root"
+
+    # List all subdirectories within storage_path once; shared by both modes.
+    subdirs = _list_subdirs(storage_path)
     
     if args.mode == "local":
         scriptForMerge = "merge_Locally.sh"
-        generate_local_merge_script(storage_path, scriptForMerge, mergeFilePattern)
+        generate_local_merge_script(storage_path, subdirs, scriptForMerge, mergeFilePattern)
     elif args.mode == "condor":
         scriptForMerge = "merge_using_condor.sub"
-        generate_condorMerge_submission_file(storage_path, scriptForMerge, mergeFilePattern)
+        generate_condorMerge_submission_file(storage_path, subdirs, scriptForMerge, mergeFilePattern)
 
 if __name__ == "__main__":
     main()
@@ -1,78 +1,297 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import stat
+import re
+import fnmatch
 import argparse
 import logging
 import time
-from ROOT import TFileMerger
+import array
+import shutil
+import tempfile
+import ROOT
+from ROOT import TFileMerger, TTreeCache, gEnv
+
+# C++ helper adding a whole list of files to a TFileMerger in a single Python -> C++ call.
+# Returns the paths that TFileMerger rejected.
+_ADD_FILES_CODE = """
+#include "TFileMerger.h"
+#include <string>
+#include <vector>
+
+namespace RootFileMergerHelpers {
+std::vector<std::string> AddFiles(TFileMerger &merger, const std::vector<std::string> &paths)
+{
+   std::vector<std::string> failed;
+   for (const auto &path : paths)
+      if (!merger.AddFile(path.c_str()))
+         failed.push_back(path);
+   return failed;
+}
+}
+"""
+
+# C++ helper merging a list of files with TBufferMerger on a ROOT::TThreadExecutor, so the
+# per-file open/clone/push work runs on native threads without holding the Python GIL.
+# Returns the paths that could not be opened.
+_BUFFERED_MERGE_CODE = """
+#include "ROOT/TBufferMerger.hxx"
+#include "ROOT/TThreadExecutor.hxx"
+#include "TClass.h"
+#include "TDirectory.h"
+#include "TFile.h"
+#include "TH1.h"
+#include "TKey.h"
+#include "TTree.h"
+#include <memory>
+#include <mutex>
+#include <set>
+#include <string>
+#include <vector>
+
+namespace RootFileMergerHelpers {
+// Trees are fast-cloned into target, other objects are read and attached to it; all of them
+// are written (and reset after the merge) by TBufferMergerFile::Write.
+void CopyDirectory(TDirectory *source, TDirectory *target)
+{
+   std::set<std::string> copied;
+   for (auto *obj : *source->GetListOfKeys()) {
+      auto *key = static_cast<TKey *>(obj);
+      // Keys are sorted by decreasing cycle; only the latest cycle of each object is copied.
+      if (!copied.insert(key->GetName()).second)
+         continue;
+      auto *cl = TClass::GetClass(key->GetClassName());
+      if (!cl)
+         continue;
+      if (cl->InheritsFrom(TDirectory::Class())) {
+         auto *subdir = target->GetDirectory(key->GetName());
+         if (!subdir)
+            subdir = target->mkdir(key->GetName());
+         CopyDirectory(source->GetDirectory(key->GetName()), subdir);
+      } else if (cl->InheritsFrom(TTree::Class())) {
+         target->cd();
+         auto *tree = source->Get<TTree>(key->GetName());
+         auto *clone = tree->CloneTree(-1, "fast");
+         // Disconnect the clone from the input tree: they must not share branch addresses or
+         // refer to each other once either file is closed.
+         clone->ResetBranchAddresses();
+         if (tree->GetListOfClones())
+            tree->GetListOfClones()->Remove(clone);
+      } else {
+         auto *object = key->ReadObj();
+         if (cl->InheritsFrom(TH1::Class()))
+            static_cast<TH1 *>(object)->SetDirectory(target); // ReadObj attached it to the input file
+         else
+            target->Append(object);
+      }
+   }
+}
+
+std::vector<std::string> MergeFilesBuffered(const std::string &outputFileName, std::vector<std::string> paths, unsigned nThreads)
+{
+   std::vector<std::string> failed;
+   std::mutex failedMutex;
+   {
+      ROOT::TBufferMerger merger(outputFileName.c_str());
+      ROOT::TThreadExecutor pool(nThreads);
+      pool.Foreach([&](const std::string &path) {
+         std::unique_ptr<TFile> input(TFile::Open(path.c_str()));
+         if (!input || input->IsZombie()) {
+            std::lock_guard<std::mutex> lock(failedMutex);
+            failed.push_back(path);
+            return;
+         }
+         // The output buffer goes out of scope (and drops its clones) before the input is closed.
+         auto output = merger.GetFile();
+         CopyDirectory(input.get(), output.get());
+         output->Write(); // Pushes the buffer to the merging queue
+      }, paths);
+   } // TBufferMerger destructor merges the remaining buffers and writes the output file
+   return failed;
+}
+}
+"""
 
 class RootFileMerger:
-    def __init__(self, base_dir, mergeFilePattern, output_file_name, logger=None):
+    # Read-ahead cache size for remote (XRootD/EOS) inputs: 32 MiB.
+    READ_CACHE_SIZE = 32 * 1024**2
+    # Number of input files TFileMerger may keep open at once; only used to raise its default limit.
+    MAX_OPENED_FILES = 400
+
+    # Prefix of every console log line.
+    LOG_PREFIX = "  [ Merging log ]: "
+    # Pre-formatted separators framing each block of log output.
+    SEPARATOR_OPEN = "\n\n" + "-" * 73 + "\n"
+    SEPARATOR_CLOSE = "\n" + "-" * 73 + "\n\n"
+
+    def __init__(self, base_dir, mergeFilePattern, output_file_name, logger=None, threads=1):
         """
         Initialize:
          - base_dir: Base directory to search for files.
          - mergeFilePattern: Pattern used to match files (e.g., "out_*.root").
          - output_file_name: Name of the merged output file.
          - logger: Logger instance for logging messages.
+         - threads: Number of threads; more than one merges with TBufferMerger instead of TFileMerger.
         """
         self.base_dir = base_dir
         self.mergeFilePattern = mergeFilePattern
+        self._pat_re = re.compile(fnmatch.translate(mergeFilePattern), re.IGNORECASE)  # Compiled once, case-insensitive glob
         self.output_file_name = output_file_name
+        self.threads = threads
         self.file_dict = {}   # Dictionary mapping directory to list of matching .root files
-        self.all_files = []   # List of all matching files
+        self._paths = []                  # Paths of all matching files
+        self._sizes = array.array('q')    # Sizes (bytes) of all matching files, parallel to _paths
         self.logger = logger if logger else logging.getLogger("merger")
 
+    @property
+    def all_files(self):
+        """List of all matching file paths."""
+        return self._paths
+
     def log(self, message):
         self.logger.info(message)
 
+    def _write_bulk(self, messages):
+        """
+        Write many per-file messages at once, bypassing the logging machinery.
+        Callers check the log level once, outside their loop; the output goes to
+        stderr like the console handler so the ordering with regular log lines is kept.
+        """
+        prefix = self.LOG_PREFIX
+        sys.stderr.write("".join(f"{prefix}{message}\n" for message in messages))
+
     def gather_files(self):
         """
-        Recursively search the base_dir for .root files that match the mergeFilePattern.
+        Recursively search the base_dir for files that match the mergeFilePattern (glob, case-insensitive).
+        Files reachable under several paths (hardlinks, symlinks) are collected only once;
+        unreadable directories and files that cannot be stat'ed (e.g. dangling symlinks) are logged and skipped.
         Logs the number of matching files found in each subdirectory.
         """
-        for root, dirs, files in os.walk(self.base_dir):
-            matching_files = [os.path.join(root, f) for f in files
-                              if f.lower().endswith('.root') and self.mergeFilePattern.split('*')[0].lower() in f.lower()]
+        # Stack-based os.scandir walk: the DirEntry carries d_type (no extra stat for is_dir)
+        # and the file size is taken here once, so no second stat pass is needed later.
+        stack = [self.base_dir]
+        seen = set()  # (st_dev, st_ino) of files already collected, to skip hardlinked/duplicate inputs
+        while stack:
+            root = stack.pop()
+            matching_files = []
+            try:
+                it = os.scandir(root)
+            except OSError as e:
+                self.log(f"Failed to list directory '{root}': {e}")
+                continue
+            with it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif self._pat_re.match(entry.name):
+                        try:
+                            st = entry.stat()
+                        except OSError as e:
+                            self.log(f"Failed to get size for file '{entry.path}': {e}")
+                            continue
+                        # Symlinks to directories are not descended into (as with os.walk) nor merged.
+                        if not stat.S_ISREG(st.st_mode):
+                            continue
+                        file_id = (st.st_dev, st.st_ino)
+                        if file_id in seen:
+                            self.log(f"Skipping '{entry.path}': same file as an already collected input.")
+                            continue
+                        seen.add(file_id)
+                        matching_files.append(entry.path)
+                        self._sizes.append(st.st_size)
             if matching_files:
                 self.file_dict[root] = matching_files
-                self.all_files.extend(matching_files)
-                self.log(f"\n\n-------------------------------------------------------------------------\n")
+                self._paths.extend(matching_files)
+                self.log(self.SEPARATOR_OPEN)
                 self.log(f"There are {len(matching_files)} .root files in directory '{root}'.")
-                self.log(f"\n-------------------------------------------------------------------------\n\n")
+                self.log(self.SEPARATOR_CLOSE)
 
     def estimate_total_size(self):
         """
         Estimate the total size (in bytes) of the collected files.
-        Logs the size of each file and the overall estimated size.
+        Uses the sizes cached by gather_files, so no additional stat is issued.
+        Logs the overall estimated size; per-file sizes are logged at DEBUG level only.
         """
-        total_size = 0
-        for file_path in self.all_files:
-            try:
-                size = os.path.getsize(file_path)
-                total_size += size
-                self.log(f"The size of file '{file_path}' is {size/1024:.2f} KB.")
-                self.log(f"The size of file '{file_path}' is {size/1024**3:.2f} GB.")
-            except Exception as e:
-                self.log(f"Failed to get size for file '{file_path}': {e}")
+        total_size = sum(self._sizes)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._write_bulk(message
+                             for file_path, size in zip(self._paths, self._sizes)
+                             for message in (f"The size of file '{file_path}' is {size/1024:.2f} KB.",
+                                             f"The size of file '{file_path}' is {size/1024**3:.2f} GB."))
 
-        self.log(f"\n\n-------------------------------------------------------------------------\n")
+        self.log(self.SEPARATOR_OPEN)
         self.log(f"Estimated total size before merging is {total_size/1024:.2f} KB.")
         self.log(f"Estimated total size before merging is {total_size/1024**3:.2f} GB.")
-        self.log(f"\n-------------------------------------------------------------------------\n\n")
+        self.log(self.SEPARATOR_CLOSE)
 
         return total_size
 
     def merge_files(self):
         """
-        Merge all collected .root files into one output file using TFileMerger.
-        Logs the progress of the merging process.
+        Merge all collected .root files into one output file using TFileMerger,
+        or TBufferMerger when more than one thread is requested.
+        An output on EOS is first written to a local temporary file and moved in place at the end.
+        Logs the progress of the merging process (per-file additions at DEBUG level only).
         """
+        # Larger read-ahead and async prefetching cut the number of small network reads from EOS.
+        TTreeCache.SetLearnEntries(1)
+        gEnv.SetValue("TFile.AsyncPrefetching", 1)
+        gEnv.SetValue("XNet.ReadCacheSize", self.READ_CACHE_SIZE)
+
+        merge = self._merge_files_buffered if self.threads > 1 else self._merge_files_serial
+
+        if not self.output_file_name.startswith("/eos/"):
+            return merge(self.output_file_name)
+
+        # Writing to EOS is a remote round-trip per buffer: merge on local disk, then move once.
+        with tempfile.TemporaryDirectory(prefix="merge_") as tmp_dir:
+            tmp_file_name = os.path.join(tmp_dir, os.path.basename(self.output_file_name))
+            self.log(f"Merging into local temporary file '{tmp_file_name}'.")
+            if not merge(tmp_file_name):
+                return False
+            try:
+                shutil.move(tmp_file_name, self.output_file_name)
+            except Exception as e:
+                self.log(f"Failed to move the merged file to '{self.output_file_name}': {e}")
+                return False
+            self.log(f"Moved the merged file to '{self.output_file_name}'.")
+            return True
+
+    def _declare_helper(self, name, code):
+        """
+        Compile the C++ helper RootFileMergerHelpers::<name> from code, once.
+        Returns False (and logs) if the compilation fails.
+        """
+        if hasattr(ROOT, "RootFileMergerHelpers") and hasattr(ROOT.RootFileMergerHelpers, name):
+            return True
+        if not ROOT.gInterpreter.Declare(code):
+            self.log(f"Failed to compile the C++ helper '{name}'!")
+            return False
+        return True
+
+    def _merge_files_serial(self, output_file_name):
+        """
+        Merge all collected .root files into output_file_name using TFileMerger.
+        """
+        # Compile the helper first: OutputFile() below recreates (truncates) the output file.
+        if not self._declare_helper("AddFiles", _ADD_FILES_CODE):
+            return False
         merger = TFileMerger(False)
         merger.SetPrintLevel(0)  # Suppress ROOT internal output
-        merger.OutputFile(self.output_file_name)
-        for file_path in self.all_files:
-            merger.AddFile(file_path)
-            self.log(f"Added file '{file_path}' to the merge list.")
+        merger.SetFastMethod(True)  # Fast-clone baskets instead of unzipping/rezipping when possible
+        # Never lower TFileMerger's own default (sysconf(_SC_OPEN_MAX) - 100): a lower limit only adds partial-merge rounds.
+        merger.SetMaxOpenedFiles(max(merger.GetMaxOpenedFiles(), min(len(self.all_files), self.MAX_OPENED_FILES)))
+        merger.OutputFile(output_file_name)
+        paths = ROOT.std.vector["std::string"](self.all_files)  # Converted in one call
+        failed = {str(path) for path in ROOT.RootFileMergerHelpers.AddFiles(merger, paths)}
+        for file_path in sorted(failed):
+            self.log(f"Failed to add file '{file_path}' to the merge list; skipping it.")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._write_bulk(f"Added file '{file_path}' to the merge list."
+                             for file_path in self.all_files if file_path not in failed)
+        self.log(f"Added {len(self.all_files) - len(failed)} of {len(self.all_files)} files to the merge list.")
         self.log("Starting the merge process.")
         success = merger.Merge()
         if not success:
@@ -82,18 +301,49 @@ class RootFileMerger:
             self.log("The merge process completed successfully.")
             return True
 
-    def compare_sizes(self, estimated_size):
+    def _merge_files_buffered(self, output_file_name):
+        """
+        Merge all collected .root files into output_file_name with TBufferMerger using self.threads threads.
+        The per-file work runs in C++ on a ROOT::TThreadExecutor: each task fast-clones the trees of one
+        input file into its own in-memory TBufferMergerFile and pushes it to the shared merger, so at most
+        self.threads input files are held in memory at once. Unreadable inputs are logged and skipped.
+        """
+        if not self.all_files:
+            self.log("No input files to merge; the merge process failed!")
+            return False
+        if not self._declare_helper("MergeFilesBuffered", _BUFFERED_MERGE_CODE):
+            return False
+        ROOT.EnableImplicitMT(self.threads)
+        paths = ROOT.std.vector["std::string"](self.all_files)  # Converted in one call
+
+        self.log(f"Starting the merge process with {self.threads} threads ({len(self.all_files)} files).")
+        failed = {str(path) for path in ROOT.RootFileMergerHelpers.MergeFilesBuffered(output_file_name, paths, self.threads)}
+        for file_path in sorted(failed):
+            self.log(f"Failed to open file '{file_path}'; skipping it.")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._write_bulk(f"Merged file '{file_path}'."
+                             for file_path in self.all_files if file_path not in failed)
+
+        if len(failed) == len(self.all_files):
+            self.log("The merge process failed!")
+            return False
+        self.log(f"The merge process completed successfully ({len(self.all_files) - len(failed)} of {len(self.all_files)} files merged).")
+        return True
+
+    def compare_sizes(self, estimated_size=None):
         """
         Compare the actual size of the merged file with the estimated size and log the difference.
+        If no estimate is given (estimation skipped), only the merged file size is logged.
         """
 
-        self.log(f"\n\n-------------------------------------------------------------------------\n")
+        self.log(self.SEPARATOR_OPEN)
 
         try:
             final_size = os.path.getsize(self.output_file_name)
             self.log(f"The merged file '{self.output_file_name}' has a size of {final_size/1024:.2f} KB.")
-            diff = final_size - estimated_size
-            self.log(f"The difference between the estimated and merged file size is {diff/1024:.2f} KB.")
+            if estimated_size is not None:
+                diff = final_size - estimated_size
+                self.log(f"The difference between the estimated and merged file size is {diff/1024:.2f} KB.")
             return final_size
         except Exception as e:
             self.log(f"Failed to obtain the size of the merged file: {e}")
@@ -107,6 +357,9 @@ def main():
     parser.add_argument("--dir", dest="base_dir", type=str, default=".", help="Base directory to search (default: current directory)")
     parser.add_argument("--pat", dest="mergeFilePattern", type=str, default="out_*.root", help="File pattern to match (default: out_*.root)")
     parser.add_argument("--out", dest="output_file_name", type=str, default="merged.root", help="Output merged file name (default: merged.root)")
+    parser.add_argument("--skip-estimate", dest="skip_estimate", action="store_true", help="Skip the estimation of the total input size before merging")
+    parser.add_argument("--verbose", dest="verbose", action="store_true", help="Also log per-file details (sizes, files added to the merge)")
+    parser.add_argument("--threads", dest="threads", type=int, default=1, help="Number of merging threads; more than 1 uses TBufferMerger (default: 1)")
     args = parser.parse_args()
 
     # Ensure base_dir is absolute.
@@ -114,8 +367,8 @@ def main():
 
     # Setup logger to output directly to console.
     logger = logging.getLogger("merger")
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter("  [ Merging log ]: %(message)s")
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    formatter = logging.Formatter(RootFileMerger.LOG_PREFIX + "%(message)s")
     sh = logging.StreamHandler()
     sh.setFormatter(formatter)
     logger.addHandler(sh)
@@ -124,10 +377,13 @@ def main():
     
     start_time = time.time()
 
-    merger_instance = RootFileMerger(args.base_dir, args.mergeFilePattern, args.output_file_name, logger)
+    merger_instance = RootFileMerger(args.base_dir, args.mergeFilePattern, args.output_file_name, logger, args.threads)
     merger_instance.gather_files()
-    estimated_size = merger_instance.estimate_total_size()
-    if merger_instance.merge_files():
+    # The estimate only sums the sizes cached by gather_files, so it is deferred until
+    # it is actually needed and the merge starts right after the file collection.
+    merged = merger_instance.merge_files()
+    if merged:
+        estimated_size = None if args.skip_estimate else merger_instance.estimate_total_size()
         merger_instance.compare_sizes(estimated_size)
     else:
         logger.info("The overall merge process failed.")
@@ -138,7 +394,11 @@ def main():
     logger.info(f"The merge job completed in {elapsed_time:.2f} seconds "
             f"({minutes} minutes and {seconds:.2f} seconds).")
 
-    self.log(f"\n-------------------------------------------------------------------------\n\n")
+    logger.info(RootFileMerger.SEPARATOR_CLOSE)
+
+    # Non-zero exit status so that batch/parallel runners notice a failed merge.
+    if not merged:
+        sys.exit(1)
 
 
 if __name__ == "__main__":